@@ -1,4 +1,4 @@
-from asgi_matomo import MatomoMiddleware
+from asgi_matomo import MatomoMiddleware, get_tracking_state
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.requests import Request
@@ -7,14 +7,14 @@ from starlette.routing import Route
 
 
 async def foo(request: Request):
-    if "state" not in request.scope:
-        request.scope["state"] = {}
-    request.scope["state"]["asgi_matomo"] = {
-        "action_name": "Foo/foo",
-        "e_c": "Foo",
-        "e_a": "Playing",
-        "cvar": {"anything": "goes"},
-    }
+    get_tracking_state(request.scope).update(
+        {
+            "action_name": "Foo/foo",
+            "e_c": "Foo",
+            "e_a": "Playing",
+            "cvar": {"anything": "goes"},
+        }
+    )
     return JSONResponse({"name": "foo"})
 
 
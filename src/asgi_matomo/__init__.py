@@ -1,5 +1,6 @@
 """Middleware for tracking ASGI reqeusts with Matomo."""
 from asgi_matomo import trackers
 from asgi_matomo.middleware import MatomoMiddleware
+from asgi_matomo.trackers import get_tracking_state
 
-__all__ = ["MatomoMiddleware", "trackers"]
+__all__ = ["MatomoMiddleware", "get_tracking_state", "trackers"]
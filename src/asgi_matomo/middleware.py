@@ -1,42 +1,125 @@
+import asyncio
+import itertools
 import json
 import logging
 import random
 import re
 import time
-import traceback
 import typing
-import urllib.parse
-from contextlib import AsyncExitStack, asynccontextmanager
-from typing import Any, AsyncIterator
+import urllib.request
+from typing import Any
+from urllib.parse import quote, quote_from_bytes
 
 import httpx
 from asgiref.typing import (
     ASGI3Application,
     ASGIReceiveCallable,
-    ASGIReceiveEvent,
     ASGISendCallable,
     ASGISendEvent,
     HTTPScope,
 )
 
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+except ImportError:
+
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+
 logger = logging.getLogger(__name__)
 
 
-_T = typing.TypeVar("_T")
+# exclude patterns that only match a static path or path prefix, e.g. '^/health'
+_STATIC_PATTERN_RE = re.compile(r"\^?(/[A-Za-z0-9_\-/]*)(\$?)")
+
+# max number of paths to remember if they are excluded or not
+_EXCLUDED_CACHE_SIZE = 1024
+# max number of (scheme, server, root_path, path) to remember the url and route details for
+_URL_CACHE_SIZE = 2048
+
+# characters allowed unescaped in a url query (RFC 3986), '%' keeps escapes as they are
+_QUERY_SAFE = "!$&'()*+,;=:@/?%"
+
+_FORM_HEADERS = {"content-type": "application/x-www-form-urlencoded"}
+
+_K = typing.TypeVar("_K")
+_V = typing.TypeVar("_V")
+
+
+def _encode_value(value: Any) -> str:
+    if isinstance(value, bytes):
+        return quote_from_bytes(value, safe="")
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return quote(str(value), safe="")
 
 
-class _DefaultLifespan:
-    def __init__(self, app: "MatomoMiddleware"):
-        self._app = app
+def _encode_query(params: dict[str, Any]) -> str:
+    """Encode tracking data as a query string.
 
-    async def __aenter__(self) -> None:
-        await self._app.startup()
+    Keys and values are percent-encoded, booleans are sent as `true`/`false` like httpx
+    does for form data and `None` values are skipped.
+    """
+    return "&".join(
+        f"{quote(str(field), safe='')}={_encode_value(value)}"
+        for field, value in params.items()
+        if value is not None
+    )
 
-    async def __aexit__(self, *exc_info: object) -> None:
-        await self._app.shutdown()
 
-    def __call__(self: _T, app: object) -> _T:
-        return self
+def _env_proxy_mounts() -> dict[str, str | None]:
+    """Get the proxy to use per url pattern from the environment, as httpx does.
+
+    A `None` proxy means that urls matching the pattern are not proxied (`NO_PROXY`).
+    """
+    proxies = urllib.request.getproxies()
+    mounts: dict[str, str | None] = {}
+    for scheme in ("http", "https", "all"):
+        if proxy := proxies.get(scheme):
+            mounts[f"{scheme}://"] = proxy if "://" in proxy else f"http://{proxy}"
+    for host in proxies.get("no", "").split(","):
+        host = host.strip()
+        if host == "*":
+            return {}
+        if host:
+            mounts[host if "://" in host else f"all://*{host.lstrip('.')}"] = None
+    return mounts
+
+
+# clients created by middlewares, shared by the middlewares running on the same event loop
+# with the same client settings, with the number of middlewares using each
+_SharedClientKey = tuple[asyncio.AbstractEventLoop, int, bool, typing.Optional[str]]
+_shared_clients: dict[_SharedClientKey, tuple[httpx.AsyncClient, int]] = {}
+
+
+def _acquire_shared_client(
+    key: _SharedClientKey, create_client: typing.Callable[[], httpx.AsyncClient]
+) -> httpx.AsyncClient:
+    client, users = _shared_clients.get(key) or (create_client(), 0)
+    _shared_clients[key] = (client, users + 1)
+    return client
+
+
+async def _release_shared_client(key: _SharedClientKey) -> None:
+    client, users = _shared_clients.pop(key)
+    if users > 1:
+        _shared_clients[key] = (client, users - 1)
+    else:
+        await client.aclose()
+
+
+def _cache_put(cache: dict[_K, _V], key: _K, value: _V, maxsize: int) -> None:
+    if len(cache) >= maxsize:
+        # forget the oldest entry
+        del cache[next(iter(cache))]
+    cache[key] = value
 
 
 class MatomoMiddleware:
@@ -44,36 +127,173 @@ class MatomoMiddleware:
         self,
         app: ASGI3Application,
         *,
-        matomo_url,
+        matomo_url: str,
         idsite: int,
         access_token: str | None = None,
         assume_https: bool = True,
         client: httpx.AsyncClient | None = None,
         exclude_paths: list[str] | None = None,
-        exclude_patterns: list[str] | None = None,
+        exclude_patterns: list[str | re.Pattern[str]] | None = None,
         route_details: dict[str, dict[str, str]] | None = None,
+        batch_size: int | None = None,
+        flush_interval: float = 5.0,
+        max_queue_size: int = 10_000,
+        track_in_background: bool = False,
+        max_concurrent_tracking: int = 64,
+        pool_size: int = 100,
+        http2: bool = False,
+        matomo_uds: str | None = None,
     ) -> None:
         self.app = app
         self.matomo_url = matomo_url
         self.idsite = idsite
         self.assume_https = assume_https
+        self._fixed_scheme = "https" if assume_https else None
         self.access_token = access_token
-        self.lifespan_context = _DefaultLifespan(self)
         self.client = client
-        self.exclude_paths = set(exclude_paths or [])
-        self.compiled_patterns = [re.compile(pattern) for pattern in (exclude_patterns or [])]
+        self.exclude_paths = frozenset(exclude_paths or ())
+        # static patterns are checked with a set lookup or str.startswith, the rest
+        # are combined into one regex so that a path is matched in one call
+        exclude_exact = set(self.exclude_paths)
+        exclude_prefixes = []
+        dynamic_patterns = []
+        separate_patterns = []
+        for pattern in exclude_patterns or []:
+            if isinstance(pattern, str):
+                if static_match := _STATIC_PATTERN_RE.fullmatch(pattern):
+                    static_path, anchored_end = static_match.groups()
+                    if anchored_end:
+                        exclude_exact.add(static_path)
+                    else:
+                        exclude_prefixes.append(static_path)
+                    continue
+                pattern = re.compile(pattern)
+            if pattern.flags != re.UNICODE or pattern.groups:
+                # flags, group names and backreference numbers don't survive being
+                # combined with other patterns, so these are matched on their own
+                separate_patterns.append(pattern)
+            else:
+                dynamic_patterns.append(pattern)
+        self._exclude_exact = frozenset(exclude_exact)
+        self._exclude_prefixes = tuple(sorted(exclude_prefixes, key=len, reverse=True))
+        self._exclude_re = None
+        if dynamic_patterns:
+            joined_patterns = "|".join(f"(?:{pattern.pattern})" for pattern in dynamic_patterns)
+            try:
+                self._exclude_re = re.compile(joined_patterns)
+            except re.error:
+                separate_patterns.extend(dynamic_patterns)
+        self._exclude_separate = tuple(separate_patterns)
+        self._has_exclusions = bool(
+            exclude_exact or exclude_prefixes or dynamic_patterns or separate_patterns
+        )
+        self._excluded_cache: dict[str, bool] = {}
+        self._url_cache: dict[tuple[str, str, str, str], tuple[str, dict[str, str] | None]] = {}
         self.route_details = route_details or {}
+        # the part of the tracking data that is the same for all requests, the
+        # per-request fields are listed as None so that a copy never has to grow
+        self._tracking_template: dict[str, Any] = {
+            "idsite": idsite,
+            "rec": 1,
+            "apiv": 1,
+            "send_image": 0,
+            "action_name": None,
+            "url": None,
+            "rand": None,
+            "ua": None,
+            "token_auth": None,
+            "cip": None,
+            "lang": None,
+            "urlref": None,
+            "gt_ms": None,
+            "cvar": None,
+        }
+        self._template_constants = {
+            field: value for field, value in self._tracking_template.items() if value is not None
+        }
+        self._template_query = _encode_query(self._template_constants)
+        # rand is only a cache buster, a counter offset by a random seed is enough
+        self._rand_base = random.getrandbits(32)  # noqa: S311
+        self._rand_counter = itertools.count()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._queue: asyncio.Queue[dict[str, Any] | None] | None = None
+        self._flusher: asyncio.Task | None = None
+        self.track_in_background = track_in_background
+        self.max_concurrent_tracking = max_concurrent_tracking
+        self._semaphore: asyncio.Semaphore | None = None
+        self._pending: set[asyncio.Task] | None = None
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.matomo_uds = matomo_uds
+        self._shared_client_key: _SharedClientKey | None = None
 
     async def startup(self) -> None:
         if self.client is None:
-            self.client = httpx.AsyncClient()
+            self._shared_client_key = (
+                asyncio.get_running_loop(),
+                self.pool_size,
+                self.http2,
+                self.matomo_uds,
+            )
+            self.client = _acquire_shared_client(self._shared_client_key, self._create_client)
+        if self.batch_size:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._flusher = asyncio.create_task(self._flush_loop())
+        elif self.track_in_background:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_tracking)
+            self._pending = set()
         print("middleware startup: done")
 
     async def shutdown(self) -> None:
-        if self.client is not None:
+        if self._queue is not None and self._flusher is not None:
+            if not self._flusher.done():
+                # flush what is left in the queue and stop the flusher
+                await self._queue.put(None)
+            await self._flusher
+            self._queue = None
+            self._flusher = None
+        if self._pending is not None:
+            pending = self._pending
+            self._pending = None
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._shared_client_key is not None:
+            await _release_shared_client(self._shared_client_key)
+            self._shared_client_key = None
+            self.client = None
+        elif self.client is not None:
             await self.client.aclose()
         print("middleware shutdown: done")
 
+    def _create_transport(self, proxy: str | None = None) -> httpx.AsyncHTTPTransport:
+        return httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=30.0,
+            ),
+            uds=self.matomo_uds,
+            proxy=httpx.Proxy(proxy) if proxy else None,
+            # retry once when a pooled connection can't be (re)established
+            retries=1,
+        )
+
+    def _create_client(self) -> httpx.AsyncClient:
+        mounts = None
+        if self.matomo_uds is None:
+            # httpx ignores the proxy environment variables when given a transport
+            mounts = {
+                pattern: self._create_transport(proxy) if proxy else None
+                for pattern, proxy in _env_proxy_mounts().items()
+            }
+        return httpx.AsyncClient(
+            transport=self._create_transport(),
+            mounts=mounts,
+            timeout=httpx.Timeout(5.0, connect=2.0),
+        )
+
     async def lifespan(
         self, scope: HTTPScope, receive: ASGIReceiveCallable, send: ASGISendCallable
     ) -> None:
@@ -81,102 +301,62 @@ class MatomoMiddleware:
         Handle ASGI lifespan messages, which allows us to manage application
         startup and shutdown events.
 
-        Code borrowed from: https://github.com/adriangb/asgi-lifespan
+        Our startup runs before the app's and our shutdown after the app's, so
+        `lifespan.shutdown.complete` is held back until we are done.
         """
-        rcv_events: dict[str, bool] = {}
-        send_events: dict[str, bool] = {}
-
-        async def wrapped_rcv() -> ASGIReceiveEvent:
-            message = await receive()
-            rcv_events[message["type"]] = True
-            return message
-
-        async def wrapped_send(message: ASGISendEvent) -> None:
-            send_events[message["type"]] = True
-            if message["type"] == "lifespan.shutdown.complete":
-                # we want to send this one ourselves
-                # once we are done
+        startup_complete = False
+        app_failed = False
+
+        async def lifespan_send(message: ASGISendEvent) -> None:
+            nonlocal startup_complete, app_failed
+            message_type = message["type"]
+            if message_type == "lifespan.shutdown.complete":
+                # sent by us once our own shutdown is done
                 return
+            if message_type == "lifespan.startup.complete":
+                startup_complete = True
+            elif message_type in ("lifespan.startup.failed", "lifespan.shutdown.failed"):
+                app_failed = True
             await send(message)
 
-        @asynccontextmanager
-        async def cleanup() -> "AsyncIterator[None]":
+        try:
+            await self.startup()
             try:
-                yield
-            except BaseException:
-                exc_text = traceback.format_exc()
-                if "lifespan.startup.complete" in send_events:
-                    await send({"type": "lifespan.shutdown.failed", "message": exc_text})
-                else:
-                    await send({"type": "lifespan.startup.failed", "message": exc_text})
-                raise
+                try:
+                    await self.app(scope, receive, lifespan_send)
+                except BaseException:  # noqa: BLE001
+                    if app_failed:
+                        # the app supports lifespans but failed and re-raised (Starlette does this)
+                        raise
+                    # the app doesn't support lifespans, the spec says to ignore the error
+                if not startup_complete and not app_failed:
+                    # the app doesn't support lifespans, so talk to the ASGI server ourselves
+                    await receive()
+                    await send({"type": "lifespan.startup.complete"})
+                    startup_complete = True
+                    # block until the ASGI server shuts us down
+                    await receive()
+            finally:
+                await self.shutdown()
+        except BaseException as exc:
+            exc_text = f"{type(exc).__name__}: {exc}"
+            if startup_complete:
+                await send({"type": "lifespan.shutdown.failed", "message": exc_text})
             else:
-                await send({"type": "lifespan.shutdown.complete"})
-
-        lifespan_cm = self.lifespan_context(self.app)
-
-        async with AsyncExitStack() as stack:
-            await stack.enter_async_context(cleanup())
-            await stack.enter_async_context(lifespan_cm)
-            try:
-                # one of 4 things will happen when we call the app:
-                # 1. it supports lifespans. it will block until the server
-                #    sends the shutdown signal, at which point we get control
-                #    back and can run our own teardown
-                # 2. it does nothing and returns. in this case we do the
-                #    back and forth with the ASGI server ourselves
-                # 3. it raises an exception.
-                #    a. before raising the exception it sent a
-                #       "lifespan.startup.failed" message
-                #       this means it supports lifespans, but it's lifespan
-                #       errored out. we'll re-raise to trigger our teardown
-                #    b. it did not send a "lifespan.startup.failed" message
-                #       this app doesn't support lifespans, the spec says
-                #       to just swallow the exception and proceed
-                # 4. it supports lifespan events and it's lifespan fails
-                #    (it sends a "lifespan.startup.failed" message)
-                #    in this case we'll run our teardown and then return
-                await self.app(scope, wrapped_rcv, wrapped_send)
-            except BaseException:  # noqa: BLE001
-                if (
-                    "lifespan.startup.failed" in send_events
-                    or "lifespan.shutdown.failed" in send_events
-                ):
-                    # the app tried to start and failed
-                    # this app re-raises the exceptions (Starlette does this)
-                    # re-raise so that our teardown is triggered
-                    raise
-                # the app doesn't support lifespans
-                # the spec says to ignore these errors and just don't send
-                # more lifespan events
-            if "lifespan.startup.failed" in send_events:
-                # the app supports lifespan events
-                # but it failed to start
-                # this app does not re-raise exceptions
-                # so all we can do is run our teardown and exit
-                return
-            if "lifespan.startup.complete" not in send_events:
-                # the app doesn't support lifespans at all
-                # so we'll have to talk to the ASGI server ourselves
-                await receive()
-                await send({"type": "lifespan.startup.complete"})
-                # we'll block here until the ASGI server shuts us down
-                await receive()
-        # even if the app sent this, we intercepted it and discarded it until we were done
-        # await send({"type": "lifespan.shutdown.complete"})
+                await send({"type": "lifespan.startup.failed", "message": exc_text})
+            raise
+        await send({"type": "lifespan.shutdown.complete"})
 
     async def __call__(
         self, scope: HTTPScope, receive: ASGIReceiveCallable, send: ASGISendCallable
     ) -> Any:
-        # locals inside the app function (send_wrapper) can't be assigned to,
-        # as the interpreter detects the assignment and thus creates a new
-        # local variable within that function, with that name.
-        instance = {"http_status_code": 500}
+        http_status_code = 500
 
-        def send_wrapper(response):
+        async def send_wrapper(response: ASGISendEvent) -> None:
+            nonlocal http_status_code
             if response["type"] == "http.response.start":
-                instance["http_status_code"] = response["status"]
-            return send(response)
+                http_status_code = response["status"]
+            await send(response)
 
         if scope["type"] == "lifespan":
             await self.lifespan(scope, receive, send)
@@ -186,48 +366,46 @@ class MatomoMiddleware:
             await self.app(scope, receive, send)
             return
 
-        # ensure 'asgi_matomo' is set in state
+        # ensure 'state' is set, so that 'asgi_matomo' is shared even if the scope is copied,
+        # 'asgi_matomo' itself is only created when used (see trackers.get_tracking_state)
         if "state" not in scope:
             scope["state"] = {}  # type: ignore
 
-        if "asgi_matomo" not in scope["state"]:  # type: ignore
-            scope["state"]["asgi_matomo"] = {}  # type: ignore
         path = scope["path"]
-        dont_track_this = False
-        if path in self.exclude_paths:
-            logger.debug("excluding path='%s'", path, extra={"path": path})
-            dont_track_this = True
-        elif any(pattern.match(path) for pattern in self.compiled_patterns):
-            logger.debug("excluding path='%s'", path, extra={"path": path})
-            dont_track_this = True
-
-        # Early exit if we don't track this path
-        if dont_track_this:
+        # Early exit if we don't track this path, before any tracking work is done
+        if self._has_exclusions and self._is_excluded(path):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("excluding path='%s'", path, extra={"path": path})
             await self.app(scope, receive, send)
             return
 
-        start_time_ns = time.perf_counter_ns()
+        # Nothing to send the tracking with, e.g. if the lifespan has not been run
+        if self.client is None:
+            logger.error("self.client is not set, can't track request")
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
 
         try:
             await self.app(scope, receive, send_wrapper)
-        except Exception:
-            raise
         finally:
-            end_time_ns = time.perf_counter_ns()
+            elapsed_ms = (time.perf_counter() - start_time) * 1000.0
 
             tracking_data = self._build_tracking_state(scope)
             tracking_data.update(
                 {
-                    "gt_ms": (end_time_ns - start_time_ns) / 1000,
+                    "gt_ms": elapsed_ms,
                     "cvar": {
-                        "http_status_code": instance["http_status_code"],
+                        "http_status_code": http_status_code,
                         "http_method": scope["method"],
                     },
                 }
             )
 
-            if "state" in scope and "asgi_matomo" in scope["state"]:  # type: ignore
-                for field, value in scope["state"]["asgi_matomo"].items():  # type: ignore
+            state = scope.get("state")
+            if state and (extra_tracking_data := state.get("asgi_matomo")):
+                for field, value in extra_tracking_data.items():
                     if (
                         field in tracking_data
                         and isinstance(tracking_data[field], dict)
@@ -237,113 +415,236 @@ class MatomoMiddleware:
                     else:
                         tracking_data[field] = value
 
-            tracking_data["cvar"] = json.dumps(tracking_data["cvar"])
+            tracking_data["cvar"] = _json_dumps(tracking_data["cvar"])
 
+            if self._queue is not None:
+                self._enqueue(tracking_data)
+            elif self._pending is not None:
+                self._schedule(tracking_data)
+            else:
+                await self._send_tracking(tracking_data)
+
+    def _is_excluded(self, path: str) -> bool:
+        excluded = self._excluded_cache.get(path)
+        if excluded is not None:
+            return excluded
+        excluded = (
+            path in self._exclude_exact
+            or path.startswith(self._exclude_prefixes)
+            or (self._exclude_re is not None and self._exclude_re.match(path) is not None)
+            or any(pattern.match(path) for pattern in self._exclude_separate)
+        )
+        _cache_put(self._excluded_cache, path, excluded, _EXCLUDED_CACHE_SIZE)
+        return excluded
+
+    def _resolve_url(
+        self, scheme: str, server: str, root_path: str, path: str
+    ) -> tuple[str, dict[str, str] | None]:
+        """Get the tracked url, without query string, and the route details for `path`."""
+        key = (scheme, server, root_path, path)
+        resolved = self._url_cache.get(key)
+        if resolved is None:
+            resolved = (f"{scheme}://{server}{root_path}{path}", self.route_details.get(path))
+            _cache_put(self._url_cache, key, resolved, _URL_CACHE_SIZE)
+        return resolved
+
+    def _enqueue(self, tracking_data: dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(tracking_data)  # type: ignore[union-attr]
+        except asyncio.QueueFull:
+            logger.warning(
+                "Tracking queue is full (max_queue_size=%d), dropping tracking data",
+                self.max_queue_size,
+            )
+
+    def _schedule(self, tracking_data: dict[str, Any]) -> None:
+        task = asyncio.create_task(self._send_tracking_in_background(tracking_data))
+        self._pending.add(task)  # type: ignore[union-attr]
+        task.add_done_callback(self._pending.discard)  # type: ignore[union-attr]
+
+    async def _send_tracking_in_background(self, tracking_data: dict[str, Any]) -> None:
+        async with self._semaphore:  # type: ignore[union-attr]
+            await self._send_tracking(tracking_data)
+
+    async def _send_tracking(self, tracking_data: dict[str, Any]) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 "Making tracking call to '%s'",
                 self.matomo_url,
                 extra={"tracking_data": tracking_data},
             )
+        try:
+            if self.client is None:
+                logger.error("self.client is not set, can't track request")
+            else:
+                tracking_response = await self.client.post(
+                    self.matomo_url,
+                    content=self._encode_tracking_data(tracking_data).encode("ascii"),
+                    headers=_FORM_HEADERS,
+                )
+                self._check_tracking_response(tracking_response)
+        except httpx.HTTPError:
+            logger.exception("Error tracking view")
+
+    async def _flush_loop(self) -> None:
+        """Collect queued tracking data and send it to Matomo in bulk.
+
+        A batch is sent when `batch_size` items are collected or when `flush_interval`
+        seconds have passed since the first item of the batch was received.
+        A `None` in the queue flushes what is collected and stops the loop.
+        """
+        queue = self._queue
+        if queue is None or not self.batch_size:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            tracking_data = await queue.get()
+            if tracking_data is None:
+                return
+            batch = [tracking_data]
+            closing = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    if queue.empty():
+                        timeout = max(deadline - loop.time(), 0)
+                        tracking_data = await asyncio.wait_for(queue.get(), timeout)
+                    else:
+                        tracking_data = queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if tracking_data is None:
+                    closing = True
+                    break
+                batch.append(tracking_data)
             try:
-                if self.client is None:
-                    logger.error("self.client is not set, can't track request")
-                else:
-                    tracking_response = await self.client.post(
-                        self.matomo_url, data=tracking_data
-                    )
-                    logger.debug(
-                        "tracking response",
-                        extra={
-                            "status": tracking_response.status_code,
-                            "content": tracking_response.text,
-                        },
-                    )
-                    if tracking_response.status_code >= 300:
-                        logger.error(
-                            "Tracking call failed (status_code=%d)",
-                            tracking_response.status_code,
-                            extra={
-                                "status_code": tracking_response.status_code,
-                                "text": tracking_response.text,
-                            },
-                        )
-            except httpx.HTTPError:
-                logger.exception("Error tracking view")
-
-    def _build_tracking_state(self, scope: HTTPScope) -> dict:
-        server = None
-        user_agent = None
-        accept_lang = None
-        cip = None
-        path = scope["path"]
-        urlref = None
-
-        for header, value in scope["headers"]:
-            if header == b"accept_lang":
-                accept_lang = value
-            elif header == b"user-agent":
-                user_agent = value
-            elif header == b"x-forwarded-server":
-                server = value.decode("utf-8")
-            elif header == b"x-forwarded-for":
-                cip = value.decode("utf-8")
-            elif header == b"referer":
-                urlref = value
-        if server is None:
+                await self._send_bulk_tracking(batch)
+            except Exception:
+                # one bad batch must not stop the flusher for the rest of the process
+                logger.exception("Error tracking views")
+            if closing:
+                return
+
+    async def _send_bulk_tracking(self, batch: list[dict[str, Any]]) -> None:
+        """Send several tracking requests in one call with Matomo's bulk tracking API."""
+        requests = []
+        for tracking_data in batch:
+            # token_auth is sent once for the whole batch
+            tracking_data.pop("token_auth", None)
+            requests.append(f"?{self._encode_tracking_data(tracking_data)}")
+        payload: dict[str, Any] = {"requests": requests}
+        if self.access_token:
+            payload["token_auth"] = self.access_token
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Making bulk tracking call to '%s'",
+                self.matomo_url,
+                extra={"batch_size": len(requests)},
+            )
+        try:
+            if self.client is None:
+                logger.error("self.client is not set, can't track requests")
+            else:
+                tracking_response = await self.client.post(self.matomo_url, json=payload)
+                self._check_tracking_response(tracking_response)
+        except httpx.HTTPError:
+            logger.exception("Error tracking views")
+
+    def _encode_tracking_data(self, tracking_data: dict[str, Any]) -> str:
+        """Encode tracking data, reusing the encoded template for the constant fields."""
+        constants = self._template_constants
+        for field, value in constants.items():
+            if tracking_data.get(field) != value:
+                # a request changed a constant field, so the encoded template doesn't apply
+                return _encode_query(tracking_data)
+        request_query = _encode_query(
+            {field: value for field, value in tracking_data.items() if field not in constants}
+        )
+        if not request_query:
+            return self._template_query
+        return f"{self._template_query}&{request_query}"
+
+    def _check_tracking_response(self, tracking_response: httpx.Response) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "tracking response",
+                extra={
+                    "status": tracking_response.status_code,
+                    "content": tracking_response.text,
+                },
+            )
+        if tracking_response.status_code >= 300:
+            logger.error(
+                "Tracking call failed (status_code=%d)",
+                tracking_response.status_code,
+                extra={
+                    "status_code": tracking_response.status_code,
+                    "text": tracking_response.text,
+                },
+            )
+
+    def _build_tracking_state(self, scope: HTTPScope) -> dict[str, Any]:
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        # on duplicated headers the last one wins
+        headers = dict(scope["headers"])
+        accept_lang = headers.get(b"accept-language")
+        user_agent = headers.get(b"user-agent")
+        urlref = headers.get(b"referer")
+        forwarded_for = headers.get(b"x-forwarded-for")
+        # the client is the first address, the rest are proxies
+        cip = forwarded_for.partition(b",")[0].strip().decode("utf-8") if forwarded_for else None
+        if forwarded_server := headers.get(b"x-forwarded-server"):
+            # only the first server is used, so only that part is decoded
+            first_server, sep, _ = forwarded_server.partition(b", ")
+            if debug and sep:
+                logger.debug(
+                    "splitting server addresses, using first",
+                    extra={"server-orig": forwarded_server, "server": first_server},
+                )
+            server = first_server.decode("utf-8")
+        else:
             if scope["server"] is None:
                 logger.error("'server' is not set in scope, skip tracking...")
                 raise RuntimeError("'server' is not set in scope")
             host, port = scope["server"]
-            logger.debug("setting server from scope", extra={"host": host, "port": port})
+            if debug:
+                logger.debug("setting server from scope", extra={"host": host, "port": port})
             server = f"{host}:{port}" if port else host
 
-        if ", " in server:
-            servers = server.split(", ")
-            logger.debug(
-                "splitting server addresses, using first",
-                extra={"server-orig": server, "servers": servers},
-            )
-            server = servers[0]
-
-        if root_path := scope.get("root_path"):
+        root_path = scope.get("root_path", "")
+        if debug and root_path:
             logger.debug("using root_path", extra={"root_path": root_path})
-            path = f"{root_path}{path}"
-
-        logger.debug(
-            "building url",
-            extra={
-                "server": server,
-                "path": path,
-                "user_agent": user_agent,
-                "accept_lang": accept_lang,
-            },
-        )
-        url = urllib.parse.urlunsplit(
-            (
-                "https" if self.assume_https else str(scope["scheme"]),
-                server,
-                path,
-                "",
-                str(scope["query_string"]) if scope.get("query_string") else None,
+        scheme = self._fixed_scheme or scope["scheme"]
+        url, route_details = self._resolve_url(scheme, server, root_path, scope["path"])
+
+        if debug:
+            logger.debug(
+                "building url",
+                extra={
+                    "server": server,
+                    "url": url,
+                    "user_agent": user_agent,
+                    "accept_lang": accept_lang,
+                },
             )
-        )
+        if query_string := scope.get("query_string"):
+            # percent-encode bytes outside the query characters, e.g. raw utf-8, so the
+            # url is kept as is without decoding it
+            url = f"{url}?{quote_from_bytes(query_string, safe=_QUERY_SAFE)}"
 
         if not cip:
             cip = scope["client"][0] if scope["client"] else None
 
-        tracking_state = {
-            "idsite": self.idsite,
-            "action_name": scope["path"],
-            "url": url,
-            "rec": 1,
-            "rand": random.getrandbits(32),
-            "apiv": 1,
-            "ua": user_agent,
-            "send_image": 0,
-        }
+        tracking_state = self._tracking_template.copy()
+        tracking_state["action_name"] = scope["path"]
+        tracking_state["url"] = url
+        tracking_state["rand"] = (self._rand_base ^ next(self._rand_counter)) & 0xFFFFFFFF
+        tracking_state["ua"] = user_agent
 
-        if scope["path"] in self.route_details:
-            tracking_state |= self.route_details[scope["path"]]
+        if route_details:
+            tracking_state |= route_details
         if self.access_token and cip:
             tracking_state["token_auth"] = self.access_token
             tracking_state["cip"] = cip
@@ -2,15 +2,16 @@ import time
 import typing
 
 
+def get_tracking_state(scope: typing.MutableMapping[str, typing.Any]) -> dict[str, typing.Any]:
+    """Get the tracking data for this request from state, created if not set."""
+    return scope.setdefault("state", {}).setdefault("asgi_matomo", {})
+
+
 class PerfMsTracker:
     """Measure time between enter and exit and records it in state."""
 
     def __init__(self, scope: typing.MutableMapping[str, typing.Any], key: str) -> None:
-        self.start_ns = 0.0
-        if "state" not in scope:
-            scope["state"] = {}
-        if "asgi_matomo" not in scope["state"]:
-            scope["state"]["asgi_matomo"] = {}
+        self.start_ns = 0
         self.scope = scope
         self.key = key
 
@@ -26,6 +27,6 @@ class PerfMsTracker:
     async def __aexit__(self, exc_type, exc_value, exc_tb):
         self._record_time(self.key, time.perf_counter_ns())
 
-    def _record_time(self, key: str, end_ns: float) -> None:
-        elapsed_time_ms = (end_ns - self.start_ns) / 1000.0
-        self.scope["state"]["asgi_matomo"][key] = elapsed_time_ms
+    def _record_time(self, key: str, end_ns: int) -> None:
+        elapsed_time_ms = (end_ns - self.start_ns) / 1_000_000
+        get_tracking_state(self.scope)[key] = elapsed_time_ms
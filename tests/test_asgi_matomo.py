@@ -1,15 +1,18 @@
+import asyncio
 import contextlib
 import json
-import time
+import logging
+import re
 import typing
-from dataclasses import dataclass
 from typing import AsyncGenerator
 from unittest import mock
+from urllib.parse import parse_qs, parse_qsl
 
+import httpx
 import pytest
 import pytest_asyncio
 from asgi_lifespan import LifespanManager
-from asgi_matomo import MatomoMiddleware
+from asgi_matomo import MatomoMiddleware, get_tracking_state, middleware, trackers
 from asgi_matomo.trackers import PerfMsTracker
 from httpx import ASGITransport, AsyncClient
 from starlette.applications import Starlette
@@ -20,123 +23,175 @@ from starlette.responses import JSONResponse, PlainTextResponse
 from starlette.routing import Route
 
 
-@dataclass
-class MockResponse:
+class MockResponse(typing.NamedTuple):
     status_code: int
     text: str = "bad response"
 
 
+class FakeClock:
+    """Stand-in for the time module that moves `step_ms` forward on every reading."""
+
+    def __init__(self, step_ms: int) -> None:
+        self.now_ns = 0
+        self.step_ns = step_ms * 1_000_000
+
+    def perf_counter_ns(self) -> int:
+        self.now_ns += self.step_ns
+        return self.now_ns
+
+    def perf_counter(self) -> float:
+        return self.perf_counter_ns() / 1_000_000_000
+
+
 def test_it_works() -> None:
     assert MatomoMiddleware is not None
 
 
-@pytest.fixture(name="matomo_client")
+@pytest.fixture(name="matomo_client", scope="session")
 def fixture_matomo_client():
-    client = mock.AsyncMock(AsyncClient)
-    client.post = mock.AsyncMock(return_value=MockResponse(status_code=204))
-    return client
+    # only what the middleware uses, without introspecting AsyncClient for a spec
+    return mock.NonCallableMock(
+        spec_set=["post", "aclose"],
+        post=mock.AsyncMock(return_value=MockResponse(status_code=204)),
+        aclose=mock.AsyncMock(),
+    )
+
+
+@pytest.fixture(autouse=True)
+def reset_matomo_client(matomo_client) -> None:
+    matomo_client.reset_mock()
+
 
+IDSITE = 1
+BASE_URL = "https://testserver"
+# compiled once and shared by every app the tests build
+_EXCLUDE_PATTERNS: list[str | re.Pattern[str]] = [
+    re.compile(".*/old.*"),
+    re.compile("^/metrics"),
+    re.compile("/internal$"),
+]
 
-@pytest.fixture(name="settings", scope="session")
-def fixture_settings() -> dict:
-    return {"idsite": 1, "base_url": "https://testserver"}
 
+# constant responses are never modified, so they are built once and reused
+_FOO_RESPONSE = PlainTextResponse("foo")
+_HEALTH_RESPONSE = PlainTextResponse("ok")
+_OLD_RESPONSE = PlainTextResponse("old")
+
+
+async def foo(request):
+    return _FOO_RESPONSE
+
+
+async def health(request):
+    return _HEALTH_RESPONSE
+
+
+async def old(request):
+    return _OLD_RESPONSE
+
+
+async def custom_var(request: Request):
+    if "state" not in request.scope:
+        request.scope["state"] = {}
+    request.scope["state"]["asgi_matomo"] = {
+        "e_a": "Playing",
+        "cvar": {"anything": "goes"},
+    }
+    with PerfMsTracker(scope=request.scope, key="pf_srv"):
+        # the tests use a FakeClock instead of waiting for real
+        pass
+    return PlainTextResponse("custom_var")
 
-def create_app(matomo_client, settings: dict, token: typing.Optional[str] = None) -> Starlette:
-    app = Starlette()
+
+async def bar(request):
+    raise HTTPException(status_code=400, detail="bar")
+
+
+async def baz(request):
+    async with PerfMsTracker(scope=request.scope, key="pf_srv"):
+        data = await request.json()
+    return JSONResponse({"data": data})
+
+
+# routes don't hold any state, so all apps share them
+_ROUTES = [
+    Route("/foo", foo),
+    Route("/foo2", foo),
+    Route("/bar", bar),
+    Route("/health", health),
+    Route("/some/old/path", old),
+    Route("/old/path", old),
+    Route("/really/old", old),
+    Route("/metrics/cpu", health),
+    Route("/internal", health),
+    Route("/internal/tracked", health),
+    Route("/set/custom/var", custom_var),
+    Route("/baz", baz, methods=["POST"]),
+]
+
+
+def create_app(matomo_client, token: typing.Optional[str] = None, **kwargs) -> Starlette:
+    app = Starlette(routes=list(_ROUTES))
 
     app.add_middleware(
         MatomoMiddleware,
         client=matomo_client,
         matomo_url="http://trackingserver",
-        idsite=settings["idsite"],
+        idsite=IDSITE,
         access_token=token,
         exclude_paths=["/health"],
-        exclude_patterns=[".*/old.*"],
+        exclude_patterns=_EXCLUDE_PATTERNS,
         route_details={"/foo2": {"action_name": "The real foo", "e_a": "fooing"}},
+        **kwargs,
     )
-
-    async def foo(request):
-        return PlainTextResponse("foo")
-
-    async def health(request):
-        return PlainTextResponse("ok")
-
-    async def old(request):
-        return PlainTextResponse("old")
-
-    async def custom_var(request: Request):
-        if "state" not in request.scope:
-            request.scope["state"] = {}
-        request.scope["state"]["asgi_matomo"] = {
-            "e_a": "Playing",
-            "cvar": {"anything": "goes"},
-        }
-        with PerfMsTracker(scope=request.scope, key="pf_srv"):
-            time.sleep(0.1)
-        return PlainTextResponse("custom_var")
-
-    async def bar(request):
-        raise HTTPException(status_code=400, detail="bar")
-
-    async def baz(request):
-        async with PerfMsTracker(scope=request.scope, key="pf_srv"):
-            data = await request.json()
-        return JSONResponse({"data": data})
-
-    app.add_route("/foo", foo)
-    app.add_route("/foo2", foo)
-    app.add_route("/bar", bar)
-    app.add_route("/health", health)
-    app.add_route("/some/old/path", old)
-    app.add_route("/old/path", old)
-    app.add_route("/really/old", old)
-    app.add_route("/set/custom/var", custom_var)
-    app.add_route("/baz", baz, methods=["POST"])
     return app
 
 
-@pytest.fixture(name="app")
-def fixture_app(matomo_client, settings: dict) -> Starlette:
-    return create_app(matomo_client, settings)
+@pytest.fixture(name="app", scope="session")
+def fixture_app(matomo_client) -> Starlette:
+    return create_app(matomo_client)
 
 
-@pytest.fixture(name="app_w_token")
-def fixture_app_w_token(matomo_client, settings: dict) -> Starlette:
-    return create_app(matomo_client, settings, token="FAKE-TOKEN")  # noqa: S106
+@pytest.fixture(name="app_w_token", scope="session")
+def fixture_app_w_token(matomo_client) -> Starlette:
+    return create_app(matomo_client, token="FAKE-TOKEN")  # noqa: S106
+
+
+_EXPECTED_DATA = {
+    "apiv": 1,
+    # "lang": ["None"]
+    "rec": 1,
+    "send_image": 0,
+}
+_EXPECTED_CVAR = {"http_status_code": 200, "http_method": "GET"}
 
 
 @pytest.fixture(name="expected_data")
-def fixture_expected_data(settings: dict) -> dict:
+def fixture_expected_data() -> dict:
+    # cvar is the only mutable value, the rest are fine to share between tests
     return {
-        "idsite": settings["idsite"],
-        "url": settings["base_url"],
-        "apiv": 1,
-        # "lang": ["None"]
-        "rec": 1,
-        "send_image": 0,
-        "cvar": '{"http_status_code": 200, "http_method": "GET"}',
+        "idsite": IDSITE,
+        "url": BASE_URL,
+        **_EXPECTED_DATA,
+        "cvar": dict(_EXPECTED_CVAR),
     }
 
 
-@pytest_asyncio.fixture(name="client")
+# the middleware is given a client, so these apps track requests without a lifespan
+@pytest_asyncio.fixture(name="client", scope="session")
 async def fixture_client(app: Starlette) -> AsyncGenerator[AsyncClient, None]:
-    async with LifespanManager(app):
-        async with AsyncClient(
-            transport=ASGITransport(app), base_url="http://testserver"
-        ) as client:
-            yield client
+    async with AsyncClient(transport=ASGITransport(app), base_url="http://testserver") as client:
+        yield client
 
 
-@pytest_asyncio.fixture(name="client_w_token")
+@pytest_asyncio.fixture(name="client_w_token", scope="session")
 async def fixture_client_w_token(
     app_w_token: Starlette,
 ) -> AsyncGenerator[AsyncClient, None]:
-    async with LifespanManager(app_w_token):
-        async with AsyncClient(
-            transport=ASGITransport(app_w_token), base_url="http://testserver"
-        ) as client:
-            yield client
+    async with AsyncClient(
+        transport=ASGITransport(app_w_token), base_url="http://testserver"
+    ) as client:
+        yield client
 
 
 @pytest.mark.asyncio
@@ -152,7 +207,7 @@ async def test_middleware_w_token_tracks_cip(
     expected_data["action_name"] = "/foo"
     expected_data["cip"] = "127.0.0.1"
     expected_data["token_auth"] = "FAKE-TOKEN"  # noqa: S105
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
 @pytest.mark.asyncio
@@ -168,57 +223,163 @@ async def test_middleware_w_token_respects_x_forwarded_for(
     expected_data["action_name"] = "/foo"
     expected_data["cip"] = "127.0.0.2"
     expected_data["token_auth"] = "FAKE-TOKEN"  # noqa: S105
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
 @pytest.mark.asyncio
-async def test_middleware_tracks_urlref(client: AsyncClient, matomo_client, expected_data: dict):
-    response = await client.get("/foo", headers={"referer": "https://example.com"})
+async def test_middleware_w_token_uses_first_x_forwarded_for(
+    client_w_token: AsyncClient, matomo_client, expected_data: dict
+):
+    response = await client_w_token.get(
+        "/foo", headers={"x-forwarded-for": "127.0.0.2, 10.0.0.1"}
+    )
     assert response.status_code == 200
 
     matomo_client.post.assert_awaited()
 
     expected_data["url"] += "/foo"
     expected_data["action_name"] = "/foo"
-    expected_data["urlref"] = b"https://example.com"
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    expected_data["cip"] = "127.0.0.2"
+    expected_data["token_auth"] = "FAKE-TOKEN"  # noqa: S105
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
 @pytest.mark.asyncio
-async def test_matomo_client_gets_called_on_get_foo(
+async def test_middleware_uses_first_x_forwarded_server(
     client: AsyncClient, matomo_client, expected_data: dict
 ):
+    response = await client.get(
+        "/foo", headers={"x-forwarded-server": "example.com, proxy.example.com"}
+    )
+    assert response.status_code == 200
+
+    matomo_client.post.assert_awaited()
+
+    expected_data["url"] = "https://example.com/foo"
+    expected_data["action_name"] = "/foo"
+    assert_post_data(posted_data(matomo_client), expected_data)
+
+
+@pytest.mark.asyncio
+async def test_middleware_logs_tracking_on_debug(
+    client: AsyncClient, matomo_client, caplog: pytest.LogCaptureFixture
+):
+    caplog.set_level(logging.DEBUG, logger="asgi_matomo")
     response = await client.get("/foo")
     assert response.status_code == 200
 
+    matomo_client.post.assert_awaited()
+    messages = [record.getMessage() for record in caplog.records]
+    assert "building url" in messages
+    assert "Making tracking call to 'http://trackingserver'" in messages
+
+
+@pytest.mark.parametrize(
+    "url, headers, extra_expected",
+    [
+        ("/foo", {}, {}),
+        ("/foo?q=a+b&page=2", {}, {}),
+        ("/foo", {"referer": "https://example.com"}, {"urlref": "https://example.com"}),
+        ("/foo", {"accept-language": "sv-SE,sv;q=0.9"}, {"lang": "sv-SE,sv;q=0.9"}),
+    ],
+    ids=["foo", "query_string", "urlref", "lang"],
+)
+@pytest.mark.asyncio
+async def test_matomo_client_gets_called_on_get(
+    client: AsyncClient,
+    matomo_client,
+    expected_data: dict,
+    url: str,
+    headers: dict,
+    extra_expected: dict,
+):
+    response = await client.get(url, headers=headers)
+    assert response.status_code == 200
+
     matomo_client.post.assert_awaited()
 
-    expected_data["url"] += "/foo"
+    expected_data["url"] += url
+    expected_data["action_name"] = "/foo"
+    expected_data |= extra_expected
+    assert_post_data(posted_data(matomo_client), expected_data)
+
+
+@pytest.mark.asyncio
+async def test_middleware_uses_request_scheme_if_not_assume_https(
+    matomo_client, expected_data: dict
+):
+    app = create_app(matomo_client, assume_https=False)
+    async with AsyncClient(transport=ASGITransport(app), base_url="http://testserver") as client:
+        response = await client.get("/foo")
+    assert response.status_code == 200
+
+    matomo_client.post.assert_awaited()
+
+    expected_data["url"] = "http://testserver/foo"
+    expected_data["action_name"] = "/foo"
+    assert_post_data(posted_data(matomo_client), expected_data)
+
+
+@pytest.mark.asyncio
+async def test_matomo_client_gets_called_with_non_ascii_query_string(
+    app: Starlette, matomo_client, expected_data: dict
+):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/foo",
+        "raw_path": b"/foo",
+        "query_string": "q=å".encode(),
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"user-agent", b"python-httpx/test")],
+        "client": ("127.0.0.1", 123),
+        "server": ("testserver", None),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message) -> None:
+        messages.append(message)
+
+    await app(scope, receive, send)
+    assert messages[0]["status"] == 200
+
+    matomo_client.post.assert_awaited()
+
+    expected_data["url"] += "/foo?q=%C3%A5"
     expected_data["action_name"] = "/foo"
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
 @pytest.mark.asyncio
 async def test_matomo_client_gets_called_on_get_bar(
     client: AsyncClient, matomo_client, expected_data: dict
 ):
-    with contextlib.suppress(ValueError):
-        _response = await client.get("/bar")
-    # assert response.status_code == 200
+    response = await client.get("/bar")
+    assert response.status_code == 400
 
     matomo_client.post.assert_awaited()
 
     expected_data["url"] += "/bar"
     expected_data["action_name"] = "/bar"
-    expected_data["cvar"] = expected_data["cvar"].replace("200", "400")
+    expected_data["cvar"]["http_status_code"] = 400
 
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
 @pytest.mark.asyncio
 async def test_matomo_client_gets_called_on_get_custom_var(
-    client: AsyncClient, matomo_client, expected_data: dict
+    client: AsyncClient, matomo_client, expected_data: dict, monkeypatch: pytest.MonkeyPatch
 ):
+    clock = FakeClock(step_ms=100)
+    monkeypatch.setattr(middleware, "time", clock)
+    monkeypatch.setattr(trackers, "time", clock)
+
     response = await client.get("/set/custom/var")
     assert response.status_code == 200
 
@@ -226,11 +387,42 @@ async def test_matomo_client_gets_called_on_get_custom_var(
 
     expected_data["url"] += "/set/custom/var"
     expected_data["e_a"] = "Playing"
-    expected_data["pf_srv"] = 90000
     expected_data["action_name"] = "/set/custom/var"
-    expected_data["cvar"] = '{"http_status_code": 200, "http_method": "GET", "anything": "goes"}'
+    expected_data["cvar"]["anything"] = "goes"
 
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    actual_data = posted_data(matomo_client)
+    # the clock is read on request start, tracker enter, tracker exit and request end
+    assert float(actual_data["gt_ms"]) == pytest.approx(300)
+    assert float(actual_data.pop("pf_srv")) == pytest.approx(100)
+    assert_post_data(actual_data, expected_data)
+
+
+@pytest.mark.asyncio
+async def test_middleware_encodes_custom_keys_in_posted_body(matomo_client) -> None:
+    async def custom_keys(request: Request):
+        get_tracking_state(request.scope).update({"ké y": "v", "a b&c": "w", "new_visit": True})
+        return _FOO_RESPONSE
+
+    app = Starlette(
+        routes=[Route("/custom/keys", custom_keys)],
+        middleware=[
+            Middleware(
+                MatomoMiddleware,
+                client=matomo_client,
+                matomo_url="http://trackingserver",
+                idsite=IDSITE,
+            )
+        ],
+    )
+    async with AsyncClient(transport=ASGITransport(app), base_url="http://testserver") as client:
+        response = await client.get("/custom/keys")
+    assert response.status_code == 200
+
+    actual_data = posted_data(matomo_client)
+    assert actual_data["ké y"] == "v"
+    assert actual_data["a b&c"] == "w"
+    assert actual_data["new_visit"] == "true"
+    assert "c" not in actual_data
 
 
 @pytest.mark.asyncio
@@ -244,7 +436,9 @@ async def test_matomo_client_doesnt_gets_called_on_get_health(
     matomo_client.post.assert_not_awaited()
 
 
-@pytest.mark.parametrize("path", ["/some/old/path", "/old/path", "/really/old"])
+@pytest.mark.parametrize(
+    "path", ["/some/old/path", "/old/path", "/really/old", "/metrics/cpu", "/internal"]
+)
 @pytest.mark.asyncio
 async def test_matomo_client_doesnt_gets_called_on_get_old(
     client: AsyncClient, matomo_client, path: str
@@ -255,22 +449,163 @@ async def test_matomo_client_doesnt_gets_called_on_get_old(
     matomo_client.post.assert_not_awaited()
 
 
+@pytest.mark.asyncio
+async def test_matomo_client_gets_called_on_path_below_excluded_path(
+    client: AsyncClient, matomo_client
+):
+    response = await client.get("/internal/tracked")
+    assert response.status_code == 200
+
+    matomo_client.post.assert_awaited()
+
+
+def test_excluded_cache_is_bounded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(middleware, "_EXCLUDED_CACHE_SIZE", 2)
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+        exclude_patterns=[".*/old.*"],
+    )
+
+    assert matomo._is_excluded("/old/path")
+    assert not matomo._is_excluded("/foo")
+    assert not matomo._is_excluded("/bar")
+    assert matomo._excluded_cache == {"/foo": False, "/bar": False}
+
+
+def test_exclude_patterns_can_be_compiled() -> None:
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+        exclude_patterns=[re.compile("^/metrics"), re.compile(".*/admin", re.IGNORECASE)],
+    )
+
+    assert matomo._is_excluded("/metrics/cpu")
+    assert matomo._is_excluded("/site/ADMIN")
+    assert not matomo._is_excluded("/foo")
+
+
+def test_exclude_patterns_keep_inline_flags_groups_and_backreferences() -> None:
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+        exclude_patterns=[
+            "(?i)/admin",
+            r"/(b)\1",
+            "/(?P<name>x)y",
+            "/(?P<name>z)w",
+            ".*/old.*",
+        ],
+    )
+
+    assert matomo._is_excluded("/ADMIN")
+    assert matomo._is_excluded("/bb")
+    assert not matomo._is_excluded("/b")
+    assert matomo._is_excluded("/xy")
+    assert matomo._is_excluded("/zw")
+    assert matomo._is_excluded("/some/old/path")
+    assert not matomo._is_excluded("/foo")
+
+
+def test_exclusions_are_only_checked_when_configured() -> None:
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+    )
+    assert not matomo._has_exclusions
+
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+        exclude_patterns=["^/metrics"],
+    )
+    assert matomo._has_exclusions
+
+
+def test_resolve_url_prepends_root_path_and_finds_route_details() -> None:
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+        route_details={"/foo": {"action_name": "Foo"}},
+    )
+
+    assert matomo._resolve_url("http", "testserver", "/api", "/foo") == (
+        "http://testserver/api/foo",
+        {"action_name": "Foo"},
+    )
+    assert matomo._resolve_url("https", "testserver", "", "/bar") == (
+        "https://testserver/bar",
+        None,
+    )
+    assert set(matomo._url_cache) == {
+        ("http", "testserver", "/api", "/foo"),
+        ("https", "testserver", "", "/bar"),
+    }
+
+
+def test_encode_query_quotes_values_and_skips_none() -> None:
+    query = middleware._encode_query(
+        {"idsite": 1, "url": "https://example.com/a b?c=d", "ua": b"agent/1.0", "lang": None}
+    )
+
+    assert query == "idsite=1&url=https%3A%2F%2Fexample.com%2Fa%20b%3Fc%3Dd&ua=agent%2F1.0"
+
+
+def test_encode_query_quotes_keys_and_encodes_bools() -> None:
+    query = middleware._encode_query({"ké y": "v", "a b&c": "w", "new_visit": True, "x": False})
+
+    assert query == "k%C3%A9%20y=v&a%20b%26c=w&new_visit=true&x=false"
+    assert parse_qs(query) == {
+        "ké y": ["v"],
+        "a b&c": ["w"],
+        "new_visit": ["true"],
+        "x": ["false"],
+    }
+
+
+def test_encode_tracking_data_sends_each_field_once() -> None:
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="http://trackingserver",
+        idsite=1,
+    )
+    template = matomo._tracking_template
+
+    assert matomo._encode_tracking_data(template.copy()) == "idsite=1&rec=1&apiv=1&send_image=0"
+    tracking_data = template | {"idsite": 2, "action_name": "/foo"}
+    query = matomo._encode_tracking_data(tracking_data)
+    assert parse_qs(query) == {
+        "idsite": ["2"],
+        "rec": ["1"],
+        "apiv": ["1"],
+        "send_image": ["0"],
+        "action_name": ["/foo"],
+    }
+
+
+def posted_data(matomo_client) -> dict[str, str]:
+    content = matomo_client.post.await_args.kwargs["content"]
+    return dict(parse_qsl(content.decode("ascii"), keep_blank_values=True))
+
+
 def assert_post_data(actual_data: dict, expected_data: dict) -> None:
-    print(f"{actual_data=}")
-    print(f"{expected_data=}")
     assert actual_data.pop("rand") is not None
     assert actual_data.pop("gt_ms") is not None
-    assert actual_data.pop("ua").decode("utf-8").startswith("python-httpx")
+    assert actual_data.pop("ua").startswith("python-httpx")
     cvar = actual_data.pop("cvar")
-    # if expected_lower_limit := expected_data.pop("pf_srv", None):
-    #     assert float(actual_data.pop("pf_srv")) >= expected_lower_limit
     expected_cvar = expected_data.pop("cvar")
     if "pf_srv" in expected_data:
         expected_lower_limit = expected_data.pop("pf_srv")
         assert float(actual_data.pop("pf_srv")) >= expected_lower_limit
 
-    assert actual_data == expected_data
-    assert json.loads(cvar) == json.loads(expected_cvar)
+    assert actual_data == {field: str(value) for field, value in expected_data.items()}
+    assert json.loads(cvar) == expected_cvar
 
 
 @pytest.mark.asyncio
@@ -282,16 +617,28 @@ async def test_matomo_client_gets_called_on_post_baz(
 
     expected_data["url"] += "/baz"
     expected_data["action_name"] = "/baz"
-    expected_data["pf_srv"] = 20
-    expected_data["cvar"] = expected_data["cvar"].replace("GET", "POST")
+    expected_data["pf_srv"] = 0
+    expected_data["cvar"]["http_method"] = "POST"
     matomo_client.post.assert_awaited()
 
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
+
+
+@pytest.mark.asyncio
+async def test_middleware_without_client_skips_tracking(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    app = create_app(None)
+    async with AsyncClient(transport=ASGITransport(app), base_url="http://testserver") as client:
+        response = await client.get("/foo")
+    assert response.status_code == 200
+
+    assert "self.client is not set, can't track request" in caplog.messages
 
 
 @pytest.mark.asyncio
-async def test_real_async_client_is_created(settings: dict) -> None:
-    app = create_app(None, settings)
+async def test_real_async_client_is_created() -> None:
+    app = create_app(None)
     async with LifespanManager(app):
         async with AsyncClient(
             transport=ASGITransport(app), base_url="http://testserver"
@@ -300,6 +647,176 @@ async def test_real_async_client_is_created(settings: dict) -> None:
             assert response.status_code == 200
 
 
+@pytest.fixture(name="proxy_env")
+def fixture_proxy_env(monkeypatch: pytest.MonkeyPatch) -> typing.Callable[[str], None]:
+    for name in ("no_proxy", "NO_PROXY", "all_proxy", "ALL_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+
+    def set_proxy(proxy_url: str) -> None:
+        for name in ("http_proxy", "HTTP_PROXY", "https_proxy", "HTTPS_PROXY"):
+            monkeypatch.setenv(name, proxy_url)
+
+    return set_proxy
+
+
+@pytest.mark.asyncio
+async def test_real_async_client_uses_proxy_from_env(proxy_env) -> None:
+    received = []
+
+    async def proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        received.append(await reader.readuntil(b"\r\n\r\n"))
+        writer.write(b"HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(proxy, host="127.0.0.1", port=0)
+    host, port = server.sockets[0].getsockname()[:2]
+    proxy_env(f"http://{host}:{port}")
+    app = create_app(None)
+    async with server, LifespanManager(app):
+        async with AsyncClient(
+            transport=ASGITransport(app), base_url="http://testserver"
+        ) as client:
+            response = await client.get("/foo")
+            assert response.status_code == 200
+
+    # the tracking call went to the proxy, asking for the Matomo url
+    assert len(received) == 1
+    assert received[0].startswith(b"POST http://trackingserver/ HTTP/1.1")
+
+
+@pytest.mark.asyncio
+async def test_real_async_client_retries_connecting(proxy_env) -> None:
+    proxy_env("http://proxy.example.com:3128")
+    matomo = MatomoMiddleware(
+        None,  # type: ignore[arg-type]
+        matomo_url="https://trackingserver",
+        idsite=1,
+    )
+
+    with mock.patch.object(
+        httpx, "AsyncHTTPTransport", wraps=httpx.AsyncHTTPTransport
+    ) as transport_cls:
+        client = matomo._create_client()
+    await client.aclose()
+
+    # the default transport and the proxied ones
+    assert transport_cls.call_count >= 2
+    assert all(call.kwargs["retries"] == 1 for call in transport_cls.call_args_list)
+
+
+@pytest.mark.asyncio
+async def test_middleware_sends_tracking_in_batches(matomo_client) -> None:
+    app = create_app(matomo_client, token="FAKE-TOKEN", batch_size=2)  # noqa: S106
+    async with LifespanManager(app):
+        async with AsyncClient(
+            transport=ASGITransport(app), base_url="http://testserver"
+        ) as client:
+            for path in ["/foo", "/foo2", "/foo"]:
+                response = await client.get(path)
+                assert response.status_code == 200
+
+    # one full batch and the rest flushed on shutdown
+    assert matomo_client.post.await_count == 2
+    first_batch, rest = (call.kwargs["json"] for call in matomo_client.post.await_args_list)
+    assert first_batch["token_auth"] == "FAKE-TOKEN"  # noqa: S105
+    assert len(first_batch["requests"]) == 2
+    assert len(rest["requests"]) == 1
+    query = parse_qs(first_batch["requests"][1][1:])
+    assert query["idsite"] == ["1"]
+    assert query["action_name"] == ["The real foo"]
+    assert query["url"] == ["https://testserver/foo2"]
+    assert query["cip"] == ["127.0.0.1"]
+    assert "token_auth" not in query
+
+
+@pytest.mark.asyncio
+async def test_middleware_keeps_flushing_after_failed_batch() -> None:
+    failing_client = mock.NonCallableMock(
+        spec_set=["post", "aclose"],
+        post=mock.AsyncMock(
+            side_effect=[httpx.InvalidURL("bad url"), MockResponse(status_code=204)]
+        ),
+        aclose=mock.AsyncMock(),
+    )
+    app = create_app(failing_client, batch_size=1)
+    async with LifespanManager(app):
+        async with AsyncClient(
+            transport=ASGITransport(app), base_url="http://testserver"
+        ) as client:
+            for path in ["/foo", "/foo2"]:
+                response = await client.get(path)
+                assert response.status_code == 200
+
+    assert failing_client.post.await_count == 2
+    (second_batch,) = (call.kwargs["json"] for call in failing_client.post.await_args_list[1:])
+    query = parse_qs(second_batch["requests"][0][1:])
+    assert query["url"] == ["https://testserver/foo2"]
+
+
+@pytest.mark.asyncio
+async def test_middleware_tracks_in_background(matomo_client) -> None:
+    app = create_app(matomo_client, track_in_background=True)
+    async with LifespanManager(app):
+        async with AsyncClient(
+            transport=ASGITransport(app), base_url="http://testserver"
+        ) as client:
+            response = await client.get("/foo")
+            assert response.status_code == 200
+
+    # pending tracking calls are awaited on shutdown
+    matomo_client.post.assert_awaited_once()
+    assert posted_data(matomo_client)["action_name"] == "/foo"
+
+
+@pytest.mark.asyncio
+async def test_real_async_client_connects_through_uds(tmp_path) -> None:
+    received = []
+
+    async def matomo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        received.append(await reader.readuntil(b"\r\n\r\n"))
+        writer.write(b"HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    uds = str(tmp_path / "matomo.sock")
+    server = await asyncio.start_unix_server(matomo, path=uds)
+    app = create_app(None, matomo_uds=uds)
+    async with server, LifespanManager(app):
+        async with AsyncClient(
+            transport=ASGITransport(app), base_url="http://testserver"
+        ) as client:
+            response = await client.get("/foo")
+            assert response.status_code == 200
+
+    assert len(received) == 1
+    assert received[0].startswith(b"POST / HTTP/1.1")
+    assert b"host: trackingserver" in received[0].lower()
+
+
+@pytest.mark.asyncio
+async def test_created_client_is_shared_between_middlewares() -> None:
+    first, second = (
+        MatomoMiddleware(
+            None,  # type: ignore[arg-type]
+            matomo_url="http://trackingserver",
+            idsite=idsite,
+        )
+        for idsite in (1, 2)
+    )
+
+    await first.startup()
+    await second.startup()
+    client = first.client
+    assert client is not None
+    assert second.client is client
+
+    await first.shutdown()
+    assert not client.is_closed
+    await second.shutdown()
+    assert client.is_closed
+
+
 @pytest.mark.asyncio
 async def test_foo2_has_custom_action_name(
     client: AsyncClient, matomo_client, expected_data: dict
@@ -313,32 +830,19 @@ async def test_foo2_has_custom_action_name(
 
     matomo_client.post.assert_awaited()
 
-    assert_post_data(matomo_client.post.await_args.kwargs["data"], expected_data)
+    assert_post_data(posted_data(matomo_client), expected_data)
 
 
-@pytest.mark.asyncio
-async def test_middleware_handles_lifespan_startups_errors():
-    # sourcery skip: remove-unreachable-code
-    @contextlib.asynccontextmanager
-    async def custom_lifespan(app):
-        raise RuntimeError("startup failure")
-        yield
+_LIFESPAN_SEND_TYPES = (
+    "lifespan.startup.complete",
+    "lifespan.startup.failed",
+    "lifespan.shutdown.complete",
+    "lifespan.shutdown.failed",
+)
 
-    async def homepage(request):
-        return JSONResponse({"a": "b"})
-
-    app = Starlette(
-        routes=[Route("/", homepage)],
-        middleware=[
-            Middleware(
-                MatomoMiddleware,
-                matomo_url="YOUR MATOMO TRACKING URL",
-                idsite=12345,  # your service tracking id
-            )
-        ],
-        lifespan=custom_lifespan,
-    )
 
+async def drive_lifespan(app, receive_types: list[str], sent: list[dict]) -> None:
+    """Run the lifespan of `app`, receiving `receive_types` in order and collecting what it sends."""
     lifespan_scope = {
         "type": "lifespan",
         "asgi": {
@@ -346,33 +850,24 @@ async def test_middleware_handles_lifespan_startups_errors():
         },
         "state": {},
     }
+    received = iter(receive_types)
 
     async def receive():
-        return {"type": "lifespan.startup"}
+        return {"type": next(received)}
 
     async def send(message) -> None:
-        assert message["type"] in (
-            "lifespan.startup.complete",
-            "lifespan.startup.failed",
-            "lifespan.shutdown.complete",
-            "lifespan.shutdown.failed",
-        )
+        assert message["type"] in _LIFESPAN_SEND_TYPES
+        sent.append(message)
 
-    with pytest.raises(RuntimeError, match="startup failure"):
-        await app(lifespan_scope, receive, send)
+    await app(lifespan_scope, receive, send)
 
 
-@pytest.mark.asyncio
-async def test_middleware_handles_lifespan_shutdown_errors():
-    @contextlib.asynccontextmanager
-    async def custom_lifespan(app):
-        yield
-        raise RuntimeError("shutdown failure")
+async def homepage(request):
+    return JSONResponse({"a": "b"})
 
-    async def homepage(request):
-        return JSONResponse({"a": "b"})
 
-    app = Starlette(
+def create_lifespan_app(lifespan) -> Starlette:
+    return Starlette(
         routes=[Route("/", homepage)],
         middleware=[
             Middleware(
@@ -381,27 +876,62 @@ async def test_middleware_handles_lifespan_shutdown_errors():
                 idsite=12345,  # your service tracking id
             )
         ],
-        lifespan=custom_lifespan,
+        lifespan=lifespan,
     )
 
-    lifespan_scope = {
-        "type": "lifespan",
-        "asgi": {
-            "version": "3.0",
-        },
-        "state": {},
+
+@pytest.mark.asyncio
+async def test_middleware_handles_lifespan_startups_errors():
+    # sourcery skip: remove-unreachable-code
+    @contextlib.asynccontextmanager
+    async def custom_lifespan(app):
+        raise RuntimeError("startup failure")
+        yield
+
+    app = create_lifespan_app(custom_lifespan)
+
+    sent: list[dict] = []
+    with pytest.raises(RuntimeError, match="startup failure"):
+        await drive_lifespan(app, ["lifespan.startup"], sent)
+
+    assert sent[-1] == {
+        "type": "lifespan.startup.failed",
+        "message": "RuntimeError: startup failure",
     }
 
-    async def receive():
-        return {"type": "lifespan.shutdown"}
 
-    async def send(message) -> None:
-        assert message["type"] in (
-            "lifespan.startup.complete",
-            "lifespan.startup.failed",
-            "lifespan.shutdown.complete",
-            "lifespan.shutdown.failed",
-        )
+@pytest.mark.asyncio
+async def test_middleware_handles_lifespan_shutdown_errors():
+    @contextlib.asynccontextmanager
+    async def custom_lifespan(app):
+        yield
+        raise RuntimeError("shutdown failure")
 
+    app = create_lifespan_app(custom_lifespan)
+
+    sent: list[dict] = []
     with pytest.raises(RuntimeError, match="shutdown failure"):
-        await app(lifespan_scope, receive, send)
+        await drive_lifespan(app, ["lifespan.startup", "lifespan.shutdown"], sent)
+
+    assert sent[-1]["type"] == "lifespan.shutdown.failed"
+
+
+@pytest.mark.asyncio
+async def test_middleware_handles_lifespan_for_apps_without_lifespan():
+    async def app_wo_lifespan(scope, receive, send):
+        assert scope["type"] == "http"
+
+    app = MatomoMiddleware(
+        app_wo_lifespan,
+        matomo_url="YOUR MATOMO TRACKING URL",
+        idsite=12345,  # your service tracking id
+    )
+
+    sent: list[dict] = []
+    await drive_lifespan(app, ["lifespan.startup", "lifespan.shutdown"], sent)
+
+    assert [message["type"] for message in sent] == [
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+    assert app.client is None
@@ -1,11 +1,13 @@
-from starlette.testclient import TestClient
+import pytest
+from httpx import ASGITransport, AsyncClient
 
 from docs_src.details.tutorial002 import app
 
 
-def test_app():
-    client = TestClient(app)
-    response = client.get("/foo")
+@pytest.mark.asyncio
+async def test_app():
+    async with AsyncClient(transport=ASGITransport(app), base_url="http://testserver") as client:
+        response = await client.get("/foo")
     assert response.status_code == 200
 
     assert response.json() == {"name": "foo"}